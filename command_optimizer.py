@@ -0,0 +1,136 @@
+import logging
+import re
+from collections.abc import Callable, Iterable, Iterator
+from typing import NamedTuple, Optional
+
+CRITERIA_RE = re.compile(r'^\s*\[con_id="?(\d+)"?\]\s*(.*?)\s*$')
+SWAP_RE = re.compile(r"^swap container with con_id (\d+)$")
+
+removed_total: int = 0
+
+
+class Command(NamedTuple):
+  # None if the command has no con_id criteria.
+  con_id: Optional[int]
+  # The command without its criteria.
+  action: str
+  payload: str
+
+  @property
+  def name(self) -> str:
+    return self.action.split(" ", 1)[0]
+
+  @property
+  def argument(self) -> str:
+    return self.action.split(" ", 1)[1] if " " in self.action else ""
+
+
+def split_commands(payload: str) -> Iterator[str]:
+  # Split on semicolons outside of quotes.
+  start = 0
+  in_quotes = False
+  for i, char in enumerate(payload):
+    if char == '"':
+      in_quotes = not in_quotes
+    elif char == ";" and not in_quotes:
+      yield payload[start:i].strip()
+      start = i + 1
+  if rest := payload[start:].strip():
+    yield rest
+
+
+def parse(payload: str) -> Command:
+  if match := CRITERIA_RE.match(payload):
+    return Command(int(match.group(1)), " ".join(match.group(2).split()), payload)
+  return Command(None, " ".join(payload.split()), payload)
+
+
+# Splits that set an absolute orientation, so that repeating one is a no-op.
+# Toggles, and layout commands (which can change the parent of the container
+# they are run on), are not included.
+ABSOLUTE_SPLITS = frozenset({"splitv", "splith", "split v", "split h",
+                             "split vertical", "split horizontal"})
+
+
+def is_split(command: Command) -> bool:
+  return command.action in ABSOLUTE_SPLITS
+
+
+def swap_target(command: Command) -> Optional[int]:
+  match = SWAP_RE.match(command.action)
+  return int(match.group(1)) if match else None
+
+
+def same(command1: Command, command2: Command) -> bool:
+  return (command1.con_id, command1.action) == (command2.con_id, command2.action)
+
+
+def repeats_earlier(out: list[Command],
+                    command: Command,
+                    transparent: Callable[[Command], bool]) -> bool:
+  # Whether an identical command was already issued, with only commands that
+  # can't affect it in between.
+  for earlier in reversed(out):
+    if same(earlier, command):
+      return True
+    if earlier.con_id is None or not transparent(earlier):
+      return False
+  return False
+
+
+def optimize_pass(commands: Iterable[Command]) -> list[Command]:
+  out: list[Command] = []
+  for command in commands:
+    prev = out[-1] if out else None
+
+    if command.con_id is None or prev is None:
+      pass
+
+    elif command.name == "focus" and not command.argument:
+      # Marks don't change focus.
+      if repeats_earlier(out, command, lambda earlier: earlier.name in ("mark", "unmark")):
+        continue
+
+    elif is_split(command):
+      # Marks don't change layouts. Splits of other containers can (splitting
+      # an only child changes its parent), so they aren't skipped over.
+      if repeats_earlier(out, command, lambda earlier: earlier.name in ("mark", "unmark")):
+        continue
+
+    elif command.name == "mark" and prev.name == "unmark" and prev.argument == command.argument:
+      # Marks are unique, so marking a container moves the mark off of any other
+      # container anyway. If the mark goes back on the same container, it was
+      # never really removed.
+      out.pop()
+      if prev.con_id == command.con_id:
+        continue
+
+    elif ((target := swap_target(command)) is not None and
+          (prev_target := swap_target(prev)) is not None and
+          {command.con_id, target} == {prev.con_id, prev_target}):
+      # Swapping the same pair twice is a no-op.
+      out.pop()
+      continue
+
+    out.append(command)
+  return out
+
+
+def optimize(payloads: Iterable[str]) -> list[str]:
+  """Removes redundant commands from a buffered command sequence.
+
+  Only commands with con_id criteria are rewritten; any other command is left
+  in place and acts as a barrier for the rewrites.
+  """
+  global removed_total
+  commands = [parse(command) for payload in payloads for command in split_commands(payload)]
+  n_commands = len(commands)
+
+  while len(optimized := optimize_pass(commands)) != len(commands):
+    commands = optimized
+
+  if removed := n_commands - len(commands):
+    removed_total += removed
+    logging.debug(f"Optimized away {removed} of {n_commands} buffered commands "
+                  f"({removed_total} in total).")
+  return [command.payload for command in commands]
@@ -1,13 +1,102 @@
+import collections
+import collections.abc
 import enum
 import logging
 import math
-from typing import Optional
+from typing import Any, Optional
 
 import i3ipc
 
 import move_counter
 
 
+class Rect:
+  __slots__ = ("x", "y", "width", "height")
+
+  def __init__(self, data: dict[str, int]) -> None:
+    self.x = data["x"]
+    self.y = data["y"]
+    self.width = data["width"]
+    self.height = data["height"]
+
+
+class Node:
+  """A compact tree node holding only the fields swaymonad reads.
+
+  Supports the subset of the i3ipc.Con interface used throughout swaymonad, so
+  it can be used wherever a Con from get_tree was used before, but is much
+  cheaper to build and keeps no reference to the raw IPC data.
+  """
+  __slots__ = ("id", "type", "layout", "name", "focused", "focus", "fullscreen_mode",
+               "floating", "rect", "nodes", "floating_nodes", "parent", "_conn")
+
+  def __init__(self, data: dict[str, Any], parent: Optional["Node"], conn: i3ipc.Connection) -> None:
+    self.id: int = data["id"]
+    self.type: str = data["type"]
+    self.layout: str = data["layout"]
+    self.name: Optional[str] = data.get("name")
+    self.focused: bool = data["focused"]
+    self.focus: list[int] = data.get("focus", [])
+    self.fullscreen_mode: int = data.get("fullscreen_mode", 0)
+    self.floating: Optional[str] = data.get("floating")
+    self.rect = Rect(data["rect"])
+    self.nodes: list[Node] = []
+    self.floating_nodes: list[Node] = []
+    self.parent = parent
+    self._conn = conn
+
+  def __repr__(self) -> str:
+    return f"{type(self).__name__}({self.id}, {self.type}, {self.layout}, {self.name!r})"
+
+  def __iter__(self) -> collections.abc.Iterator["Node"]:
+    # Breadth-first, matching i3ipc.Con.
+    queue = collections.deque(self.nodes)
+    queue.extend(self.floating_nodes)
+    while queue:
+      con = queue.popleft()
+      yield con
+      queue.extend(con.nodes)
+      queue.extend(con.floating_nodes)
+
+  def leaves(self) -> list["Node"]:
+    return [con for con in self
+            if not con.nodes and con.type == "con" and con.parent.type != "dockarea"]
+
+  def find_by_id(self, id: int) -> Optional["Node"]:
+    return next((con for con in self if con.id == id), None)
+
+  def find_focused(self) -> Optional["Node"]:
+    return next((con for con in self if con.focused), None)
+
+  def workspace(self) -> Optional["Node"]:
+    con: Optional[Node] = self
+    while con is not None and con.type != "workspace":
+      con = con.parent
+    return con
+
+  def command(self, command: str) -> list[i3ipc.CommandReply]:
+    return self._conn.command(f'[con_id="{self.id}"] {command}')
+
+
+def parse_tree(data: dict[str, Any],
+               conn: i3ipc.Connection,
+               workspace_ids: Optional[collections.abc.Set[int]] = None,
+               parent: Optional[Node] = None) -> Node:
+  """Builds a Node tree from a decoded GET_TREE reply.
+
+  If workspace_ids is given, workspaces not in it are left out of the tree
+  entirely, without descending into their containers.
+  """
+  node = Node(data, parent, conn)
+  for child in data.get("nodes", ()):
+    if workspace_ids is not None and child["type"] == "workspace" and child["id"] not in workspace_ids:
+      continue
+    node.nodes.append(parse_tree(child, conn, workspace_ids, node))
+  for child in data.get("floating_nodes", ()):
+    node.floating_nodes.append(parse_tree(child, conn, workspace_ids, node))
+  return node
+
+
 def get_workspaces(i3: i3ipc.Connection) -> list[i3ipc.Con]:
   return [i3.get_tree().find_by_id(reply.ipc_data["id"]).workspace()
           for reply in i3.get_workspaces()]
@@ -16,10 +105,27 @@ def get_workspaces(i3: i3ipc.Connection) -> list[i3ipc.Con]:
 def get_focused_workspace(i3: i3ipc.Connection) -> i3ipc.Con:
   for reply in i3.get_workspaces():
     if reply.focused:
-      return i3.get_tree().find_by_id(reply.ipc_data["id"]).workspace()
+      workspace_id = reply.ipc_data["id"]
+      return i3.get_tree(workspace_ids={workspace_id}).find_by_id(workspace_id)
   raise Exception("No workspaces were focused. This should never happen")
 
 
+def get_focused_workspace_id(i3: i3ipc.Connection) -> int:
+  # Much cheaper than get_focused_workspace as it doesn't fetch the tree.
+  for reply in i3.get_workspaces():
+    if reply.focused:
+      return reply.ipc_data["id"]
+  raise Exception("No workspaces were focused. This should never happen")
+
+
+def get_focused_id(i3: i3ipc.Connection) -> Optional[int]:
+  # The id of the node focused by the first seat, which may be a workspace if
+  # it's empty, or None if no node (e.g. a layer surface) is focused.
+  for seat in i3.get_seats():
+    return seat.focus or None
+  return None
+
+
 def get_focused_window(i3: i3ipc.Connection) -> i3ipc.Con:
   # Should never return None because we start with the focused workspace.
   return get_focused_workspace(i3).find_focused()
@@ -38,9 +144,17 @@ def get_workspace_of_event(i3: i3ipc.Connection, event: i3ipc.Event) -> Optional
 
 
 def refetch_container(i3: i3ipc.Connection, container: i3ipc.Con) -> i3ipc.Con:
+  if container.type == "workspace":
+    return i3.get_tree(workspace_ids={container.id}).find_by_id(container.id)
   return i3.get_tree().find_by_id(container.id)
 
 
+def get_output_name(container: i3ipc.Con) -> Optional[str]:
+  while container is not None and container.type != "output":
+    container = container.parent
+  return container.name if container is not None else None
+
+
 def tree_str(container: i3ipc.Con, indent: str = "") -> str:
   out = f"{indent} {container.id} {container.layout}\n"
   for node in container.nodes:
@@ -78,7 +192,16 @@ def insert_node_at_index(i3: i3ipc.Connection,
 
 
 def add_node_to_front(i3: i3ipc.Connection, container: i3ipc.Con, node: i3ipc.Con) -> None:
-  insert_node_at_index(i3, container, node, 0)
+  if not container.nodes or container.nodes[0].nodes:
+    insert_node_at_index(i3, container, node, 0)
+    return
+
+  # Moving a window to a mark on a leaf places it right after that leaf, so a
+  # single swap brings it to the front, however many nodes the container has.
+  logging.debug(f"Inserting node {node.id} at the front of container {container.id}.")
+  first = container.nodes[0]
+  move_container(node, first)
+  node.command(f"swap container with con_id {first.id}")
 
 
 def ensure_split(container: i3ipc.Con, split: str) -> list[i3ipc.replies.CommandReply]:
@@ -0,0 +1,128 @@
+import configparser
+import logging
+import os
+from collections.abc import Collection, Mapping
+from typing import Any, NamedTuple, Optional
+
+import window_rules
+
+
+class LayoutSettings(NamedTuple):
+  layout: str = "tall"
+  n_masters: int = 1
+  # None means the layout's own default.
+  n_columns: Optional[int] = None
+
+
+class Config:
+  """Layout settings, compiled into lookup tables keyed by workspace and output name.
+
+  Settings for a workspace are resolved, per field, from its [workspace:NAME]
+  section, then from the [output:NAME] section of its output, then from the
+  [default] section.
+
+  Window rules are defined in [rule:NAME] sections and tried in file order.
+  """
+
+  def __init__(self,
+               default: LayoutSettings,
+               workspaces: Mapping[str, Mapping[str, Any]],
+               outputs: Mapping[str, Mapping[str, Any]],
+               rules: window_rules.RuleIndex = window_rules.RuleIndex()) -> None:
+    self.default = default
+    self.workspaces = dict(workspaces)
+    self.outputs = dict(outputs)
+    self.rules = rules
+    self._cache: dict[tuple[str, Optional[str]], LayoutSettings] = {}
+
+  def lookup(self, workspace_name: str, output_name: Optional[str]) -> LayoutSettings:
+    key = (workspace_name, output_name)
+    if (settings := self._cache.get(key)) is None:
+      overrides = {**self.outputs.get(output_name, {}), **self.workspaces.get(workspace_name, {})}
+      settings = self._cache[key] = self.default._replace(**overrides)
+    return settings
+
+
+def default_path() -> str:
+  config_home = os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config"))
+  return os.path.join(config_home, "swaymonad", "config.ini")
+
+
+def parse_section(section: configparser.SectionProxy, valid_layouts: Collection[str]) -> dict[str, Any]:
+  settings: dict[str, Any] = {}
+  for key in section:
+    if key == "layout":
+      if (layout := section[key]) not in valid_layouts:
+        raise ValueError(f"Invalid layout {layout!r} in section [{section.name}], "
+                         f"valid options are {sorted(valid_layouts)}.")
+      settings[key] = layout
+    elif key in ("n_masters", "n_columns"):
+      if (value := section.getint(key)) < (1 if key == "n_masters" else 2):
+        raise ValueError(f"Invalid {key} {value} in section [{section.name}].")
+      settings[key] = value
+    else:
+      raise ValueError(f"Unknown option {key!r} in section [{section.name}].")
+  return settings
+
+
+RULE_KEYS = {"app_id": "app_id", "class": "window_class", "title": "title", "window_type": "window_type"}
+
+
+def parse_rule(section: configparser.SectionProxy) -> window_rules.Rule:
+  name = section.name.removeprefix("rule:")
+  criteria: dict[str, str] = {}
+  action = None
+  for key in section:
+    if key == "action":
+      try:
+        action = window_rules.Action(section[key].upper())
+      except ValueError:
+        raise ValueError(f"Invalid action {section[key]!r} in section [{section.name}], valid options "
+                         f"are {[action.value.lower() for action in window_rules.Action]}.")
+    elif key in RULE_KEYS:
+      criteria[RULE_KEYS[key]] = section[key]
+    else:
+      raise ValueError(f"Unknown option {key!r} in section [{section.name}].")
+
+  if action is None:
+    raise ValueError(f"Missing action in section [{section.name}].")
+  if not criteria:
+    raise ValueError(f"Section [{section.name}] must set at least one of {sorted(RULE_KEYS)}.")
+  return window_rules.Rule(name, action, **criteria)
+
+
+def load(path: Optional[str],
+         valid_layouts: Collection[str],
+         default_layout: Optional[str] = None) -> Config:
+  parser = configparser.ConfigParser(default_section="__none__", interpolation=None)
+  if path and os.path.exists(path):
+    logging.debug(f"Loading config from {path}.")
+    with open(path) as f:
+      parser.read_file(f)
+
+  default: dict[str, Any] = {}
+  workspaces: dict[str, dict[str, Any]] = {}
+  outputs: dict[str, dict[str, Any]] = {}
+  rules: list[window_rules.Rule] = []
+  for name in parser.sections():
+    if name.startswith("rule:"):
+      rules.append(parse_rule(parser[name]))
+      continue
+
+    settings = parse_section(parser[name], valid_layouts)
+    if name == "default":
+      default = settings
+    elif name.startswith("workspace:"):
+      workspaces[name.removeprefix("workspace:")] = settings
+    elif name.startswith("output:"):
+      outputs[name.removeprefix("output:")] = settings
+    else:
+      raise ValueError(f"Unknown section [{name}].")
+
+  if default_layout is not None:
+    default["layout"] = default_layout
+
+  return Config(LayoutSettings(**default), workspaces, outputs, window_rules.RuleIndex(rules))
+
+
+CONFIG = Config(LayoutSettings(), {}, {})
@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from collections.abc import Callable
+from typing import Any
+
+
+# Runs a batch of parsed commands, blocking until they have been executed, and
+# raises if any of them failed.
+Dispatcher = Callable[[list[list[str]]], None]
+
+
+class ControlRequestHandler(socketserver.StreamRequestHandler):
+  server: "ControlServer"
+
+  def handle(self) -> None:
+    for line in self.rfile:
+      if not (request := line.decode("utf-8", "replace").strip()):
+        continue
+
+      logging.debug(f"Received control socket request: {request!r}")
+      try:
+        if request == "stats":
+          self.reply({"success": True, "stats": self.server.stats()})
+          continue
+        commands = self.server.parse(request)
+        self.server.dispatch(commands)
+        reply = {"success": True, "commands": len(commands)}
+      except Exception as ex:
+        logging.debug(f"Control socket request {request!r} failed: {ex!r}")
+        reply = {"success": False, "error": str(ex)}
+      self.reply(reply)
+
+  def reply(self, reply: dict[str, Any]) -> None:
+    self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+    self.wfile.flush()
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  """Accepts swaymonad commands directly over a unix socket.
+
+  Each line sent to the socket is a batch of one or more commands, in the same
+  syntax as a binding (the leading nop is optional), e.g.
+  "set_layout 3_col; promote_window". Each batch is run as a single unit of
+  work and answered with a line of JSON once it has been executed.
+
+  The special request "stats" is answered with swaymonad's internal counters.
+  """
+  daemon_threads = True
+
+  def __init__(self,
+               path: str,
+               parse: Callable[[str], list[list[str]]],
+               dispatch: Dispatcher,
+               stats: Callable[[], dict[str, Any]]) -> None:
+    if os.path.exists(path):
+      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+          sock.connect(path)
+        except OSError:
+          # Left behind by an instance that didn't shut down cleanly.
+          os.unlink(path)
+        else:
+          raise RuntimeError(f"Another instance is already listening on {path}.")
+    super().__init__(path, ControlRequestHandler)
+    self.path = path
+    self.parse = parse
+    self.dispatch = dispatch
+    self.stats = stats
+
+  def start(self) -> None:
+    logging.debug(f"Listening for commands on {self.path}.")
+    threading.Thread(target=self.serve_forever, name="control-socket", daemon=True).start()
+
+  def server_close(self) -> None:
+    super().server_close()
+    if os.path.exists(self.path):
+      os.unlink(self.path)
+
+
+def default_path() -> str:
+  runtime_dir = os.environ.get("XDG_RUNTIME_DIR", "/tmp")
+  return os.path.join(runtime_dir, f"swaymonad.{os.getuid()}.sock")
@@ -4,6 +4,8 @@ from typing import Any, Optional
 import i3ipc
 
 import common
+import layout
+import window_tracker
 
 
 def find_offset_window(current_container: i3ipc.Con,
@@ -30,10 +32,37 @@ def find_prev_window(current_container: i3ipc.Con) -> Optional[i3ipc.Con]:
   return find_offset_window(current_container, -1)
 
 
+def get_focused_window(i3: i3ipc.Connection) -> Optional[i3ipc.Con]:
+  # Also records the leaf order of the focused workspace from the tree read, so
+  # that the next focus or swap command can use it.
+  generation = window_tracker.structure_generation
+  focused_window = common.get_focused_window(i3)
+  if focused_window and (workspace := focused_window.workspace()):
+    window_tracker.record_workspace(workspace, generation)
+  return focused_window
+
+
+def offset_id(leaf_ids: list[int], current_id: int, offset: int) -> int:
+  return leaf_ids[(leaf_ids.index(current_id) + offset) % len(leaf_ids)]
+
+
 def focus_window(i3: i3ipc.Connection,
                  offset: int,
                  window: Optional[i3ipc.Con] = None) -> None:
-  focused_window = window or common.get_focused_window(i3)
+  # Without an explicit window, cycle through the leaves tracked from events
+  # and layout passes, if they are up to date, without reading the tree at all.
+  if window is None and (tracked := window_tracker.focused_leaves()):
+    focused_id, fullscreen, leaf_ids = tracked
+    new_id = offset_id(leaf_ids, focused_id, offset)
+    logging.debug(f"Focusing tracked window {new_id} at offset {offset} from {focused_id}.")
+    command = f'[con_id="{new_id}"] focus'
+    if fullscreen:
+      command += f'; [con_id="{new_id}"] fullscreen'
+    i3.command(command)
+    window_tracker.record_focus(new_id, fullscreen)
+    return
+
+  focused_window = window or get_focused_window(i3)
   if not focused_window:
     return
 
@@ -41,6 +70,7 @@ def focus_window(i3: i3ipc.Connection,
     new_window.command("focus")
     if focused_window.fullscreen_mode == 1:
       new_window.command("fullscreen")
+    window_tracker.record_focus(new_window.id, focused_window.fullscreen_mode == 1)
 
 
 def focus_next_window(i3: i3ipc.Connection,
@@ -57,25 +87,40 @@ def focus_prev_window(i3: i3ipc.Connection,
   focus_window(i3, -1, window)
 
 
-def refocus_window(i3: i3ipc.Connection, window: i3ipc.Con) -> None:
-  # window.command("focus") can leave the cursor on the border of a window,
-  # while this will move the cursor to the center of the window.
-  focus_next_window(i3, None, window)
-  window.command("focus")
-  if window.fullscreen_mode == 1:
-    window.command("fullscreen")
+def center_cursor(i3: i3ipc.Connection, window: i3ipc.Con) -> None:
+  # Warp the cursor straight to the center of the window, rather than focusing
+  # another window and back, which would send focus events for both.
+  x = window.rect.x + window.rect.width // 2
+  y = window.rect.y + window.rect.height // 2
+  i3.command(f"seat - cursor set {x} {y}")
 
 
 def swap_with_window(i3: i3ipc.Connection,
                      offset: int,
                      window: Optional[i3ipc.Con] = None,
                      focus_after_swap: bool = True) -> None:
-  focused_window = window or common.get_focused_window(i3)
+  if window is None and (tracked := window_tracker.focused_leaves()):
+    focused_id, fullscreen, leaf_ids = tracked
+    new_id = offset_id(leaf_ids, focused_id, offset)
+    logging.debug(f"Swapping tracked window {focused_id} with {new_id} at offset {offset}.")
+    command = f'[con_id="{focused_id}"] swap container with con_id {new_id}'
+    if focus_after_swap:
+      command += f'; [con_id="{focused_id}"] focus'
+      if fullscreen:
+        command += f'; [con_id="{new_id}"] fullscreen'
+    i3.command(command)
+    layout.record_swap(focused_id, new_id)
+    if focus_after_swap:
+      window_tracker.record_focus(focused_id, fullscreen)
+    return
+
+  focused_window = window or get_focused_window(i3)
   if not focused_window:
     return
 
   if new_window := find_offset_window(focused_window, offset):
     focused_window.command(f"swap container with con_id {new_window.id}")
+    layout.record_swap(focused_window.id, new_window.id)
     if focus_after_swap:
       focused_window.command("focus")
       if focused_window.fullscreen_mode == 1:
@@ -2,18 +2,30 @@ import abc
 import collections.abc
 import logging
 import traceback
-from typing import Optional, Protocol
+from typing import Any, Optional, Protocol
 
 import i3ipc
 
 import common
+import config
+import move_counter
 import transformations
+import window_tracker
+import work_queue
 
 
 class Layout(abc.ABC):
   i3: i3ipc.Connection
   workspace_id: int
+  # The name of the workspace as of the last time the layout was looked up,
+  # used to find the workspace again if sway restarts and ids change.
+  workspace_name: Optional[str]
+  # The key of the layout in LAYOUTS.
+  layout_name: Optional[str]
   n_masters: int
+  # Ids of the master containers, in layout order, as of the last layout pass.
+  # Empty for layouts that don't have a notion of masters.
+  master_ids: list[int]
   active_transformations: set[transformations.Transformation]
 
   @abc.abstractmethod
@@ -25,8 +37,11 @@ class Layout(abc.ABC):
                n_masters: int = 1,
                transforms: collections.abc.Set[transformations.Transformation] = frozenset()):
     self.workspace_id = workspace_id
+    self.workspace_name = None
+    self.layout_name = None
     self.n_masters = n_masters
     self.active_transformations = set(transforms)
+    self.master_ids = []
     self.old_workspace: i3ipc.Con = None
 
   def __repr__(self) -> str:
@@ -42,15 +57,20 @@ class Layout(abc.ABC):
     logging.debug(f"Decremented n_masters for workspace {self.workspace_id} to {self.n_masters}.")
     return self.n_masters
 
+  def record_swap(self, con1_id: int, con2_id: int) -> None:
+    self.master_ids = [con2_id if con_id == con1_id else con1_id if con_id == con2_id else con_id
+                       for con_id in self.master_ids]
+
   def move(self, i3: i3ipc.Connection, direction: str) -> None:
     focused_window = common.get_focused_window(i3)
     i3.command(f"focus {direction}")
     new_window = common.get_focused_window(i3)
     focused_window.command(f"swap container with con_id {new_window.id}")
+    record_swap(focused_window.id, new_window.id)
     focused_window.command("focus")
 
   def workspace(self, i3: i3ipc.Connection) -> i3ipc.Con:
-    return i3.get_tree().find_by_id(self.workspace_id)
+    return i3.get_tree(workspace_ids={self.workspace_id}).find_by_id(self.workspace_id)
 
   def transform_command(self, command: str) -> str:
     if transformations.Transformation.TRANSPOSE in self.active_transformations:
@@ -67,31 +87,154 @@ class Layout(abc.ABC):
   def refetch_container(self, i3: i3ipc.Connection) -> None:
     self.old_workspace = common.refetch_container(i3, self.old_workspace)
 
+  def ordered_nodes(self, container: i3ipc.Con) -> list[i3ipc.Con]:
+    # The nodes of the container in layout order, i.e. with any reflections undone.
+    return container.nodes[
+      ::(-1 if
+         ((transformations.Transformation.REFLECTX in self.active_transformations and
+           container.layout == "splith") or
+          (transformations.Transformation.REFLECTY in self.active_transformations and
+           container.layout == "splitv"))
+         else 1)
+    ]
+
+  def ordered_leaves(self, container: i3ipc.Con) -> list[i3ipc.Con]:
+    # The tiled leaves under the container in layout order.
+    if not container.nodes:
+      return [container] if container.type == "con" else []
+    return [leaf for node in self.ordered_nodes(container) for leaf in self.ordered_leaves(node)]
+
+  def rebalance(self, i3: i3ipc.Connection, workspace: i3ipc.Con) -> bool:
+    # Brings the workspace back into shape after a window was added to or
+    # removed from it, working only from the tree given, so that the commands
+    # can be planned without reading from sway. Returns False if that takes a
+    # full layout pass.
+    return False
+
+  def update_masters(self, workspace: i3ipc.Con) -> None:
+    pass
+
 
 class LayoutConstructionProtocol(Protocol):
   def __call__(self,
                workspace_id: int,
                n_masters: int = ...,
-               transforms: collections.abc.Set[transformations.Transformation] = ...) -> Layout: ...
+               transforms: collections.abc.Set[transformations.Transformation] = ...,
+               **options: Any) -> Layout: ...
 
 
 LAYOUTS: dict[str, LayoutConstructionProtocol] = {}
 
 WORKSPACE_LAYOUTS: dict[str, Layout] = {}
 
-DEFAULT_LAYOUT = "tall"
+
+def column_count(settings: config.LayoutSettings) -> Optional[int]:
+  # Only column-based layouts take a column count, and fall back to their own
+  # if the settings don't have one.
+  keywords = getattr(LAYOUTS[settings.layout], "keywords", {})
+  if "n_columns" not in keywords:
+    return None
+  return settings.n_columns if settings.n_columns is not None else keywords["n_columns"]
+
+
+def create_layout(settings: config.LayoutSettings,
+                  workspace_id: int,
+                  transforms: collections.abc.Set[transformations.Transformation] = frozenset()) -> Layout:
+  options = {}
+  if (n_columns := column_count(settings)) is not None:
+    options["n_columns"] = n_columns
+  workspace_layout = LAYOUTS[settings.layout](workspace_id=workspace_id,
+                                              n_masters=settings.n_masters,
+                                              transforms=transforms,
+                                              **options)
+  workspace_layout.layout_name = settings.layout
+  return workspace_layout
 
 
 def get_layout(workspace: i3ipc.Con) -> Layout:
   if workspace.id not in WORKSPACE_LAYOUTS:
-    WORKSPACE_LAYOUTS[workspace.id] = LAYOUTS[DEFAULT_LAYOUT](workspace_id=workspace.id)
+    settings = config.CONFIG.lookup(workspace.name, common.get_output_name(workspace))
+    WORKSPACE_LAYOUTS[workspace.id] = create_layout(settings, workspace.id)
     logging.debug(
       f"Workspace {workspace.id} has no layout, setting default {WORKSPACE_LAYOUTS[workspace.id]}.")
   workspace_layout = WORKSPACE_LAYOUTS[workspace.id]
+  workspace_layout.workspace_name = workspace.name
   logging.debug(f"Retreived workspace layout {workspace_layout} for workspace {workspace.id}.")
   return workspace_layout
 
 
+def apply_config(i3: i3ipc.Connection, new_config: config.Config) -> None:
+  # Settings changed at runtime (with set_layout or *_masters) win over the
+  # config, which only replaces settings that still have their old config value.
+  old_config, config.CONFIG = config.CONFIG, new_config
+  for reply in i3.get_workspaces():
+    workspace_id = reply.ipc_data["id"]
+    if (current_layout := WORKSPACE_LAYOUTS.get(workspace_id)) is None:
+      continue
+
+    old_settings = old_config.lookup(reply.name, reply.output)
+    new_settings = new_config.lookup(reply.name, reply.output)
+    if old_settings == new_settings:
+      continue
+
+    layout_name = current_layout.layout_name
+    if layout_name is None or layout_name == old_settings.layout:
+      layout_name = new_settings.layout
+    n_masters = current_layout.n_masters
+    if n_masters == old_settings.n_masters:
+      n_masters = new_settings.n_masters
+    settings = new_settings._replace(layout=layout_name, n_masters=n_masters)
+    n_columns = column_count(settings)
+    if ((layout_name, n_masters, n_columns) ==
+        (current_layout.layout_name, current_layout.n_masters,
+         getattr(current_layout, "n_columns", None))):
+      logging.debug(f"Effective settings of workspace {workspace_id} are unchanged.")
+      continue
+
+    if layout_name != current_layout.layout_name:
+      WORKSPACE_LAYOUTS[workspace_id] = create_layout(
+        settings, workspace_id, current_layout.active_transformations)
+      WORKSPACE_LAYOUTS[workspace_id].workspace_name = reply.name
+      WORKSPACE_LAYOUTS[workspace_id].master_ids = current_layout.master_ids
+    else:
+      current_layout.n_masters = n_masters
+      if n_columns is not None:
+        current_layout.n_columns = n_columns
+    logging.debug(f"Settings of workspace {workspace_id} changed from {old_settings} to "
+                  f"{new_settings}, {current_layout} is now {WORKSPACE_LAYOUTS[workspace_id]}.")
+    schedule_relayout(i3, workspace_id)
+
+
+def resync_layouts(i3: i3ipc.Connection) -> None:
+  # Re-keys the layouts by the current ids of their workspaces, matched up by
+  # name, dropping the layouts of workspaces that no longer exist. Container ids
+  # may have changed too, so all state derived from them is dropped.
+  layouts_by_name = {workspace_layout.workspace_name: workspace_layout
+                     for workspace_layout in WORKSPACE_LAYOUTS.values()
+                     if workspace_layout.workspace_name is not None}
+  WORKSPACE_LAYOUTS.clear()
+  for reply in i3.get_workspaces():
+    if (workspace_layout := layouts_by_name.get(reply.name)) is None:
+      continue
+    old_workspace_id = workspace_layout.workspace_id
+    workspace_layout.workspace_id = reply.ipc_data["id"]
+    workspace_layout.master_ids = []
+    workspace_layout.old_workspace = None
+    WORKSPACE_LAYOUTS[workspace_layout.workspace_id] = workspace_layout
+    logging.debug(f"Resynced {workspace_layout} of workspace {reply.name!r} "
+                  f"(previously workspace {old_workspace_id}).")
+    schedule_relayout(i3, workspace_layout.workspace_id)
+
+
+def record_swap(con1_id: int, con2_id: int) -> None:
+  # Swaps exchange the positions of two containers, potentially across
+  # workspaces, so keep every layout's view of its masters, and the tracked
+  # leaf order, in sync until the next layout pass.
+  for workspace_layout in WORKSPACE_LAYOUTS.values():
+    workspace_layout.record_swap(con1_id, con2_id)
+  window_tracker.record_swap(con1_id, con2_id)
+
+
 def set_layout(i3: i3ipc.Connection,
                event: i3ipc.Event,
                layout: str) -> None:
@@ -101,16 +244,41 @@ def set_layout(i3: i3ipc.Connection,
     workspace_id=workspace.id,
     n_masters=current_layout.n_masters,
     transforms=current_layout.active_transformations)
+  WORKSPACE_LAYOUTS[workspace.id].workspace_name = workspace.name
+  WORKSPACE_LAYOUTS[workspace.id].layout_name = layout
   logging.debug(f"Changing layout of workspace {workspace.id} from {current_layout} to {layout} .")
   i3.command("mode default")
 
-  workspace_layout = get_layout(workspace)
-  workspace_layout.layout(i3, event)
+  schedule_relayout(i3, workspace.id)
+
+
+def relayout(i3: i3ipc.Connection, workspace_id: int) -> None:
+  if (workspace_layout := WORKSPACE_LAYOUTS.get(workspace_id)) is None:
+    logging.debug(f"Workspace {workspace_id} no longer has a layout, not running relayout.")
+    return
+
+  with i3.buffered_commands():
+    workspace_layout.layout(i3, None)
+
+
+def schedule_relayout(i3: i3ipc.Connection, workspace_id: int) -> None:
+  # Relayouts without an event only depend on the state of the workspace at the
+  # time they run, so any number of them queued for the same workspace can be
+  # collapsed into one.
+  work_queue.QUEUE.put(work_queue.Priority.RELAYOUT,
+                       f"relayout of workspace {workspace_id}",
+                       lambda: relayout(i3, workspace_id),
+                       key=("relayout", workspace_id))
 
 
 def layout_dispatcher(i3: i3ipc.Connection, event: i3ipc.Event) -> None:
   try:
     logging.debug(f"Received layout event: {event.ipc_data}")
+    if event.change == "move" and move_counter.value:
+      logging.debug(f"Move counter was non-zero ({move_counter.value}), ignoring move event.")
+      move_counter.decrement()
+      return
+
     workspace = (common.get_workspace_of_event(i3, event) or
                  common.get_focused_workspace(i3))
     if workspace is None:
@@ -119,9 +287,11 @@ def layout_dispatcher(i3: i3ipc.Connection, event: i3ipc.Event) -> None:
 
     logging.debug(f"Applying to workspace {workspace.id}.")
     layout = get_layout(workspace)
-    i3.enable_command_buffering()
-    layout.layout(i3, event)
-    i3.disable_command_buffering()
+    with i3.buffered_commands():
+      layout.layout(i3, event)
+
+    if event.change == "close":
+      window_tracker.forget_container(event.container.id)
   except Exception as ex:
     traceback.print_exc()
 
@@ -135,7 +305,7 @@ def increment_masters_dispatcher(i3: i3ipc.Connection, event: i3ipc.Event) -> No
   logging.debug(f"Applying to workspace {workspace.id}.")
   layout = get_layout(workspace)
   layout.increment_masters()
-  layout.layout(i3, None)
+  schedule_relayout(i3, workspace.id)
 
 
 def decrement_masters_dispatcher(i3: i3ipc.Connection, event: i3ipc.Event) -> None:
@@ -147,7 +317,7 @@ def decrement_masters_dispatcher(i3: i3ipc.Connection, event: i3ipc.Event) -> No
   logging.debug(f"Applying to workspace {workspace.id}.")
   layout = get_layout(workspace)
   layout.decrement_masters()
-  layout.layout(i3, None)
+  schedule_relayout(i3, workspace.id)
 
 
 def move_dispatcher(i3: i3ipc.Connection, event: i3ipc.Event, direction: str) -> None:
@@ -178,7 +348,12 @@ def transformation_dispatcher(i3: i3ipc.Connection, event: i3ipc.Event,
     layout.active_transformations.add(transformation)
   logging.debug(f"Workspace {workspace.id} now has transformations {layout.active_transformations}.")
   globals()[transformation.value.lower()](i3, event)
-  layout.layout(i3, None)
+  # The transformation reorders the windows with swaps and moves we don't
+  # track, so until the relayout has run, neither the masters nor the leaf
+  # order recorded by the last pass can be relied on.
+  layout.master_ids = []
+  window_tracker.forget_workspace(workspace.id)
+  schedule_relayout(i3, workspace.id)
 
 
 def transpose_dispatcher(i3: i3ipc.Connection, event: i3ipc.Event) -> None:
@@ -199,19 +374,119 @@ def reflecty_dispatcher(i3: i3ipc.Connection, event: i3ipc.Event) -> None:
 #     child.command("split none")
 
 
-def relayout_old_workspace(i3: i3ipc.Connection, new_workspace: i3ipc.Con) -> None:
-  old_workspace = common.get_focused_workspace(i3)
-  logging.debug(f"Detected container move from workspace {old_workspace.id} to {new_workspace.id}.")
+def relayout_old_workspace(i3: i3ipc.Connection, new_workspace: i3ipc.Con, container_id: int) -> None:
+  old_workspace_id = window_tracker.container_workspace(container_id)
+  logging.debug(f"Detected container move from workspace {old_workspace_id} to {new_workspace.id}.")
+
+  # The container may not have been seen in a layout pass yet (or was moved
+  # within its workspace), in which case assume it came from the previously
+  # focused workspace, as with a move between outputs.
+  if old_workspace_id is None or old_workspace_id == new_workspace.id:
+    old_workspace_id = window_tracker.previous_workspace(exclude=new_workspace.id)
+    logging.debug(f"Container {container_id} had no other known workspace, "
+                  f"assuming it came from previously focused workspace {old_workspace_id}.")
+    if old_workspace_id is None:
+      return
+
+  if old_workspace_id not in WORKSPACE_LAYOUTS:
+    if (old_workspace := i3.get_tree(workspace_ids={old_workspace_id}).find_by_id(old_workspace_id)) is None:
+      logging.debug(f"Workspace {old_workspace_id} no longer exists, not running layout.")
+      return
+    get_layout(old_workspace)
+  schedule_relayout(i3, old_workspace_id)
+
+
+def send_to_workspace(i3: i3ipc.Connection,
+                      event: i3ipc.Event,
+                      workspace_name: str,
+                      position: str = "master") -> None:
+  del event
+  if position not in ("master", "stack"):
+    raise ValueError(f"Invalid position {position!r}, valid options are 'master' and 'stack'.")
+
+  tree = i3.get_tree()
+  window = tree.find_focused()
+  source = window.workspace() if window else None
+  if window is None or source is None or window.type == "workspace":
+    logging.debug("No window is focused, not sending anything.")
+    return
+  destination = next((con for con in tree
+                      if con.type == "workspace" and con.name == workspace_name), None)
+  if destination is not None and destination.id == source.id:
+    return
+
+  # Place the window where it belongs in the destination directly instead of
+  # letting sway put it next to the destination's focused window, and mark
+  # the resulting move as our own so that no reactive relayout of either
+  # workspace is run for it.
+  destination_leaves = destination.leaves() if destination is not None else []
+  if not destination_leaves or common.is_floating(window):
+    logging.debug(f"Sending container {window.id} to workspace {workspace_name!r}.")
+    move_counter.increment()
+    window.command(f'move container to workspace "{workspace_name}"')
+    relayout_after_send(i3, source, workspace_name)
+    return
+
+  # Mirror the move in the tree we have first, so that both workspaces can be
+  # rebalanced from it in the same batch of commands as the move itself.
+  destination_layout = get_layout(destination)
+  ordered_leaves = destination_layout.ordered_leaves(destination) or destination_leaves
+  if position == "master":
+    master_id = next(iter(destination_layout.master_ids), ordered_leaves[0].id)
+    anchor = destination.find_by_id(master_id) or ordered_leaves[0]
+  else:
+    anchor = ordered_leaves[-1]
+
+  container = window
+  while container is not source and not container.nodes:
+    container.parent.nodes.remove(container)
+    container = container.parent
+
+  # Moving to a mark places the window right after the anchor, and a swap
+  # then puts it right before it, but within a reflected container that's
+  # the other way around in layout order.
+  siblings = anchor.parent.nodes
+  reflected = len(siblings) > 1 and destination_layout.ordered_nodes(anchor.parent)[0] is not siblings[0]
+  swap = (position == "master") != reflected
+  anchor_index = siblings.index(anchor)
+  siblings.insert(anchor_index if swap else anchor_index + 1, window)
+  window.parent = anchor.parent
+
+  logging.debug(f"Sending container {window.id} to workspace {destination.id} "
+                f"as {position} next to container {anchor.id}.")
+  common.move_container(window, anchor)
+  if swap:
+    window.command(f"swap container with con_id {anchor.id}")
+    record_swap(window.id, anchor.id)
+  window_tracker.container_workspaces[window.id] = destination.id
+
+  rebalanced = []
+  for workspace in (source, destination):
+    workspace_layout = get_layout(workspace)
+    if workspace_layout.rebalance(i3, workspace):
+      # The leaf order isn't recorded, as the events of the moves just sent
+      # will make it stale anyway.
+      workspace_layout.old_workspace = workspace
+      workspace_layout.update_masters(workspace)
+      rebalanced.append(workspace.id)
+
+  if rebalanced == [source.id, destination.id]:
+    logging.debug(f"Rebalanced workspaces {source.id} and {destination.id} without a layout pass.")
+    i3.command(f'workspace --no-auto-back-and-forth "{source.name}"')
+    return
+
+  logging.debug(f"Only rebalanced workspaces {rebalanced}, running full layout passes.")
+  relayout_after_send(i3, source, workspace_name)
 
-  # Necessary for move left/right between outputs.
-  if old_workspace.id == new_workspace.id:
-    i3.command("workspace back_and_forth")
-    old_workspace = common.get_focused_workspace(i3)
-    i3.command("workspace back_and_forth")
-    logging.debug(f"Old and new workspaces were identical, actual old workspace is {old_workspace.id}.")
 
-  old_workspace_layout = get_layout(old_workspace)
-  old_workspace_layout.layout(i3, None)
+def relayout_after_send(i3: i3ipc.Connection, source: i3ipc.Con, workspace_name: str) -> None:
+  get_layout(source).layout(i3, None)
+  destination = next((con for con in i3.get_tree()
+                      if con.type == "workspace" and con.name == workspace_name), None)
+  if destination is not None:
+    get_layout(destination).layout(i3, None)
+    # Commands run on the destination's windows can focus it.
+    i3.command(f'workspace --no-auto-back-and-forth "{source.name}"')
 
 
 def transpose(i3: i3ipc.Connection, event: i3ipc.Event) -> None:
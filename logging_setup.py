@@ -0,0 +1,79 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+from typing import Optional
+
+FORMAT = '%(asctime)s, %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s'
+
+
+class RateLimitFilter(logging.Filter):
+  """Lets through at most `rate` debug records per second from each logging call.
+
+  Records of higher levels are never dropped. The number of records dropped
+  from a call is appended to the next record from that call to be let through.
+  """
+
+  def __init__(self, rate: int) -> None:
+    super().__init__()
+    self.rate = rate
+    # (filename, lineno) -> [window start, records let through, records dropped]
+    self._calls: dict[tuple[str, int], list] = {}
+    # Records are logged from several threads.
+    self._lock = threading.Lock()
+
+  def filter(self, record: logging.LogRecord) -> bool:
+    if record.levelno > logging.DEBUG:
+      return True
+
+    with self._lock:
+      return self._filter(record)
+
+  def _filter(self, record: logging.LogRecord) -> bool:
+    key = (record.pathname, record.lineno)
+    if (call := self._calls.get(key)) is None:
+      call = self._calls[key] = [record.created, 0, 0]
+
+    if record.created - call[0] >= 1.0:
+      if call[2]:
+        record.msg = f"{record.getMessage()} ({call[2]} similar messages suppressed)"
+        record.args = None
+      call[:] = [record.created, 0, 0]
+
+    if call[1] >= self.rate:
+      call[2] += 1
+      return False
+    call[1] += 1
+    return True
+
+
+def setup(level: int,
+          filename: Optional[str] = None,
+          max_bytes: int = 0,
+          backup_count: int = 0,
+          rate_limit: int = 0) -> None:
+  """Routes all logging through a queue to a background thread doing the I/O.
+
+  If filename is given, the log file is rotated once it reaches max_bytes (if
+  non-zero), keeping backup_count old files.
+  """
+  if filename:
+    handler: logging.Handler = logging.handlers.RotatingFileHandler(
+      filename, maxBytes=max_bytes, backupCount=backup_count)
+  else:
+    handler = logging.StreamHandler()
+  handler.setFormatter(logging.Formatter(FORMAT))
+
+  log_queue: queue.SimpleQueue = queue.SimpleQueue()
+  queue_handler = logging.handlers.QueueHandler(log_queue)
+  if rate_limit:
+    queue_handler.addFilter(RateLimitFilter(rate_limit))
+
+  root = logging.getLogger()
+  root.setLevel(level)
+  root.addHandler(queue_handler)
+
+  listener = logging.handlers.QueueListener(log_queue, handler)
+  listener.start()
+  atexit.register(listener.stop)
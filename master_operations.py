@@ -3,6 +3,7 @@ from typing import Optional
 import i3ipc
 
 import common
+import layout
 
 
 def find_biggest_window(container: i3ipc.Con) -> Optional[i3ipc.Con]:
@@ -11,30 +12,40 @@ def find_biggest_window(container: i3ipc.Con) -> Optional[i3ipc.Con]:
              default=None)
 
 
+def find_master_id(i3: i3ipc.Connection) -> Optional[int]:
+  workspace_id = common.get_focused_workspace_id(i3)
+  workspace_layout = layout.WORKSPACE_LAYOUTS.get(workspace_id)
+  if workspace_layout and workspace_layout.master_ids:
+    return workspace_layout.master_ids[0]
+
+  # Layouts that don't arrange windows (e.g. Nop) don't track their masters, so
+  # fall back to guessing from window sizes.
+  master = find_biggest_window(common.get_focused_workspace(i3))
+  return master.id if master else None
+
+
 def focus_master(i3: i3ipc.Connection, event: i3ipc.Event) -> None:
   del event
-  workspace = common.get_focused_workspace(i3)
-  master = find_biggest_window(workspace)
-  if not master:
+  master_id = find_master_id(i3)
+  if not master_id:
     return
-  master.command("focus")
+  i3.command(f'[con_id="{master_id}"] focus')
 
 
 def resize_master(i3: i3ipc.Connection, event: i3ipc.Event, *resize: str) -> None:
   del event
-  workspace = common.get_focused_workspace(i3)
-  master = find_biggest_window(workspace)
-  if not master:
+  master_id = find_master_id(i3)
+  if not master_id:
     return
-  master.command('resize ' + ' '.join(resize))
+  i3.command(f'[con_id="{master_id}"] resize ' + ' '.join(resize))
 
 
 def promote_window(i3: i3ipc.Connection, event: i3ipc.Event) -> None:
   del event
-  workspace = common.get_focused_workspace(i3)
-  focused_window = common.get_focused_window(i3)
-  master = find_biggest_window(workspace)
-  if not master:
+  master_id = find_master_id(i3)
+  focused_id = common.get_focused_id(i3)
+  if not master_id or not focused_id or focused_id == master_id:
     return
-  focused_window.command(f"swap container with con_id {master.id}")
-  focused_window.command("focus")
+  i3.command(f'[con_id="{focused_id}"] swap container with con_id {master_id}; '
+             f'[con_id="{focused_id}"] focus')
+  layout.record_swap(focused_id, master_id)
@@ -1,3 +1,4 @@
+import itertools
 import math
 import logging
 import sys
@@ -12,6 +13,7 @@ import cycle_windows
 import layout
 import move_counter
 import transformations
+import window_tracker
 
 
 def balance_cols(i3: i3ipc.Connection,
@@ -42,10 +44,89 @@ class NCol(layout.Layout):
   def __init__(self, n_columns: int, *args, **kwargs):
     super().__init__(*args, **kwargs)
     self.n_columns = n_columns
+    # Hooks of window events to run once the workspace has been reflowed.
+    self.post_hooks: list[Callable[[], None]] = []
+    self.relayout_pending = False
 
   def __repr__(self) -> str:
     return f"{type(self).__name__}({self.workspace_id}, {self.n_columns}, {self.n_masters})"
 
+  def update_masters(self, workspace: i3ipc.Con) -> None:
+    if not (columns := self.ordered_nodes(workspace)):
+      self.master_ids = []
+    elif not (master_col := columns[0]).nodes:
+      self.master_ids = [master_col.id]
+    else:
+      self.master_ids = [node.id for node in self.ordered_nodes(master_col)]
+    logging.debug(f"Masters of workspace {self.workspace_id} are now {self.master_ids}.")
+
+  def column_targets(self, n_leaves: int) -> Optional[list[int]]:
+    # The number of leaves each column ends up with after a full reflow, or
+    # None if that would leave fewer than n_columns columns.
+    n_slaves = n_leaves - self.n_masters
+    if self.n_columns < 2 or n_slaves < self.n_columns - 1:
+      return None
+    slaves_per_col = math.ceil(n_slaves / (self.n_columns - 1))
+    last_col = n_slaves - slaves_per_col * (self.n_columns - 2)
+    if last_col < 1:
+      return None
+    return [self.n_masters] + [slaves_per_col] * (self.n_columns - 2) + [last_col]
+
+  def rebalance(self, i3: i3ipc.Connection, workspace: i3ipc.Con) -> bool:
+    """Rebalances the columns of an already laid out workspace with the fewest moves.
+
+    After a single window opens or closes, only the columns between it and the
+    end of the workspace are off by one, so windows are shifted across just
+    the boundaries that need it instead of rescanning every column. Returns
+    False without doing anything if the workspace isn't in a shape this can
+    handle, in which case it needs a full reflow.
+    """
+    columns = self.ordered_nodes(workspace)
+    split = self.transform_command("splitv")
+    if (len(columns) != self.n_columns or
+        any(col.layout != split or not col.nodes or any(node.nodes for node in col.nodes)
+            for col in columns)):
+      logging.debug(f"Workspace {workspace.id} doesn't have {self.n_columns} plain columns, "
+                    "can't rebalance incrementally.")
+      return False
+
+    counts = [len(col.nodes) for col in columns]
+    if (targets := self.column_targets(sum(counts))) is None:
+      return False
+
+    # The number of windows that have to cross the boundary after each column,
+    # rightwards if positive.
+    flows = list(itertools.accumulate(count - target
+                                      for count, target in zip(counts[:-1], targets[:-1])))
+    logging.debug(f"Rebalancing columns of workspace {workspace.id} from {counts} to {targets} "
+                  f"with flows {flows}.")
+
+    while any(flows):
+      moved = False
+      for i, flow in enumerate(flows):
+        col1, col2 = columns[i], columns[i+1]
+        # Never take the last window out of a column, as sway would destroy the
+        # column. Another boundary will have fed it first.
+        if flow > 0 and len(col1.nodes) > 1:
+          logging.debug(f"Moving container {col1.nodes[-1].id} right.")
+          common.add_node_to_front(i3, col2, col1.nodes[-1])
+          col2.nodes.insert(0, col1.nodes.pop(-1))
+          flows[i] -= 1
+          moved = True
+        elif flow < 0 and len(col2.nodes) > 1:
+          logging.debug(f"Moving container {col2.nodes[0].id} left.")
+          common.move_container(col2.nodes[0], col1)
+          col1.nodes.append(col2.nodes.pop(0))
+          flows[i] += 1
+          moved = True
+
+      if not moved:
+        logging.debug(f"Can't rebalance workspace {workspace.id} without emptying a column, "
+                      f"{flows} left to move.")
+        return False
+
+    return True
+
   def reflow(self, i3: i3ipc.Connection, workspace: i3ipc.Con) -> bool:
     if len(workspace.leaves()) == 1:
       return False
@@ -64,14 +145,7 @@ class NCol(layout.Layout):
     logging.debug(f"Reflowing {len(leaves)} leaves into {self.n_masters} masters "
                   f"and {n_slaves} slaves with {slaves_per_col} slaves per column.")
 
-    nodes = workspace.nodes[
-      ::(-1 if
-         ((transformations.Transformation.REFLECTX in self.active_transformations and
-           workspace.layout == "splith") or
-          (transformations.Transformation.REFLECTY in self.active_transformations and
-           workspace.layout == "splitv"))
-         else 1)
-    ]
+    nodes = self.ordered_nodes(workspace)
 
     caused_mutation = False
 
@@ -142,7 +216,9 @@ class NCol(layout.Layout):
     logging.debug(f"Running layout for workspace {workspace.id}.")
 
     should_reflow = event is None
-    post_hooks: list[Callable[[], None]] = []
+    post_hooks = self.post_hooks
+    if event is None:
+      self.relayout_pending = False
 
     # Have new windows displace the current window instead of being opened below them.
     if event and event.change == "new":
@@ -176,12 +252,12 @@ class NCol(layout.Layout):
       leaf_ids = {leaf.id for leaf in workspace.leaves()}
 
       if (old_leaf_ids != leaf_ids and
-          workspace.id == common.get_focused_workspace(i3).id and
+          workspace.id == common.get_focused_workspace_id(i3) and
           (closed_container := self.old_workspace.find_by_id(event.container.id)) and
           not common.is_floating(closed_container)):
         should_reflow = True
 
-        logging.debug(f"Looking at container {closed_container.id}: {closed_container.__dict__}")
+        logging.debug(f"Looking at container {closed_container.id}: {closed_container}")
         window_was_fullscreen = closed_container.fullscreen_mode == 1
         next_window = closed_container
         for _ in range(len(old_leaf_ids)):
@@ -195,25 +271,39 @@ class NCol(layout.Layout):
             break
 
     elif event and event.change == "move":
-      if move_counter.value:
-        logging.debug(f"Move counter was non-zero ({move_counter.value}), ignoring move event.")
-        move_counter.decrement()
-        return
-      else:
-        should_reflow = True
-
-        # split commands bring focus to the workspace of the window they are run
-        # on, and they may be run as part of the reflow layer, so refocus the
-        # current workspace at the end.
-        focused_workspace = common.get_focused_workspace(i3)
-        post_hooks.append(lambda: i3.command(f"workspace {focused_workspace.name}"))
-
-        window_of_event = workspace.find_by_id(event.container.id)
-        cycle_windows.swap_with_prev_window(
-          i3, event, window=window_of_event, focus_after_swap=False)
-        layout.relayout_old_workspace(i3, workspace)
+      # Moves caused by swaymonad itself are filtered out by layout_dispatcher, so
+      # this was a move by the user.
+      should_reflow = True
+
+      # split commands bring focus to the workspace of the window they are run
+      # on, and they may be run as part of the reflow layer, so refocus the
+      # current workspace at the end.
+      if focused_workspace := window_tracker.focused_workspace():
+        _, focused_workspace_name = focused_workspace
+        post_hooks.append(lambda: i3.command(f"workspace {focused_workspace_name}"))
+
+      window_of_event = workspace.find_by_id(event.container.id)
+      cycle_windows.swap_with_prev_window(
+        i3, event, window=window_of_event, focus_after_swap=False)
+      layout.relayout_old_workspace(i3, workspace, event.container.id)
+
+    # The reflow of a burst of window events on the workspace is run just once,
+    # by a relayout queued behind them, along with their post hooks.
+    if event is not None:
+      if should_reflow:
+        self.relayout_pending = True
+        layout.schedule_relayout(i3, workspace.id)
+      elif not self.relayout_pending:
+        self.run_post_hooks()
+      self.record_workspace(i3, workspace)
+      return
 
     ever_reflowed = should_reflow
+    if should_reflow:
+      workspace = common.refetch_container(i3, workspace)
+      if self.rebalance(i3, workspace):
+        should_reflow = False
+        workspace = common.refetch_container(i3, workspace)
     while should_reflow:
       workspace = common.refetch_container(i3, workspace)
       should_reflow = self.reflow(i3, workspace)
@@ -221,13 +311,22 @@ class NCol(layout.Layout):
     # Move the mouse nicely to the middle of the focused window instead of it
     # continuing to sit in its old position or on a window boundary.
     if (ever_reflowed and
-        workspace.id == common.get_focused_workspace(i3).id and
+        workspace.id == common.get_focused_workspace_id(i3) and
         (focused := workspace.find_focused())):
-      logging.debug(f"Refocusing container {focused.id}.")
-      cycle_windows.refocus_window(i3, focused)
+      logging.debug(f"Centering the cursor on container {focused.id}.")
+      cycle_windows.center_cursor(i3, focused)
+
+    self.run_post_hooks()
+    self.record_workspace(i3, workspace)
 
+  def run_post_hooks(self) -> None:
+    post_hooks, self.post_hooks = self.post_hooks, []
     for hook in post_hooks:
       hook()
 
+  def record_workspace(self, i3: i3ipc.Connection, workspace: i3ipc.Con) -> None:
+    generation = window_tracker.structure_generation
     self.old_workspace = common.refetch_container(i3, workspace)
+    self.update_masters(self.old_workspace)
+    window_tracker.record_workspace(self.old_workspace, generation)
     #logging.debug(f"Storing workspace:\n{common.tree_str(self.old_workspace)}")
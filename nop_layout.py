@@ -3,6 +3,7 @@ from typing import Optional
 import i3ipc
 
 import layout
+import window_tracker
 
 
 class Nop(layout.Layout):
@@ -11,10 +12,13 @@ class Nop(layout.Layout):
     i3.command(f"move {direction}")
 
   def layout(self, i3: i3ipc.Connection, event: Optional[i3ipc.Event]) -> None:
+    generation = window_tracker.structure_generation
     workspace = self.workspace(i3)
 
     if event and event.change == "move":
-      layout.relayout_old_workspace(i3, workspace)
+      layout.relayout_old_workspace(i3, workspace, event.container.id)
 
     if focued := workspace.find_focused():
       focued.command("focus")
+
+    window_tracker.record_workspace(workspace, generation)
@@ -0,0 +1,121 @@
+import collections
+import json
+import logging
+import socket
+import struct
+import threading
+from typing import Optional
+
+import i3ipc
+
+
+class CommandPipeline:
+  """Sends commands on a dedicated socket without waiting for their replies.
+
+  sway answers the messages on a socket in the order it received them, so
+  replies are matched up with their commands by a reader thread as they arrive,
+  and failures are logged along with the command that caused them. Anything
+  that needs to observe the effects of the commands sent so far (i.e. any read
+  of sway's state) must call wait() first.
+  """
+
+  def __init__(self, conn: i3ipc.Connection, timeout: Optional[float] = None) -> None:
+    self._conn = conn
+    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._socket.settimeout(timeout)
+    self._socket.connect(conn.socket_path)
+    self._send_lock = threading.Lock()
+    self._cond = threading.Condition()
+    # Payloads sent but not yet replied to, oldest first.
+    self._in_flight: collections.deque[str] = collections.deque()
+    self._closed = False
+    self.sent = 0
+    self.failed = 0
+    threading.Thread(target=self._read_replies, name="command-pipeline", daemon=True).start()
+
+  def submit(self, payload: str) -> None:
+    message = self._conn._pack(i3ipc.connection.MessageType.COMMAND, payload)
+    # Replies are read without holding the send lock, so a full socket buffer
+    # can't deadlock the reader and the sender.
+    with self._send_lock:
+      with self._cond:
+        if self._closed:
+          raise ConnectionError("Command pipeline is closed.")
+        self._in_flight.append(payload)
+      self._socket.sendall(message)
+      self.sent += 1
+
+  def wait(self, timeout: Optional[float] = None) -> bool:
+    """Blocks until every submitted command has been replied to.
+
+    Returns False if the timeout expired first.
+    """
+    with self._cond:
+      return self._cond.wait_for(lambda: not self._in_flight or self._closed, timeout)
+
+  def close(self) -> None:
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+    try:
+      self._socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+
+  def _read_replies(self) -> None:
+    try:
+      while (data := self._recv_reply()) is not None:
+        with self._cond:
+          payload = self._in_flight.popleft()
+          if not self._in_flight:
+            self._cond.notify_all()
+        self._check_replies(payload, i3ipc.CommandReply._parse_list(json.loads(data)))
+    except OSError as ex:
+      logging.debug(f"Command pipeline stopped reading replies: {ex!r}")
+    finally:
+      self.close()
+
+  def _recv_exactly(self, n: int) -> bytes:
+    data = bytearray()
+    while len(data) < n:
+      with self._cond:
+        waiting_for_reply = bool(self._in_flight)
+      try:
+        chunk = self._socket.recv(n - len(data))
+      except socket.timeout:
+        # Being idle is fine, but a reply that doesn't arrive in time means sway
+        # stalled, and the pipeline is closed so that the next submit reconnects.
+        if data or waiting_for_reply:
+          raise
+        continue
+      if not chunk:
+        if data:
+          raise ConnectionError(f"Connection closed {len(data)} bytes into a {n} byte read.")
+        break
+      data += chunk
+    return bytes(data)
+
+  def _recv_reply(self) -> Optional[str]:
+    # Unlike i3ipc's _ipc_recv, never reads past the end of the reply, as the
+    # next one may already be right behind it. Returns None on EOF.
+    header = self._recv_exactly(self._conn._struct_header_size)
+    if not header:
+      return None
+    magic, length, _ = struct.unpack(self._conn._struct_header, header)
+    if magic != self._conn._MAGIC.encode("utf-8"):
+      raise ConnectionError(f"Reply has bad magic {magic!r}.")
+    if not (payload := self._recv_exactly(length)) and length:
+      raise ConnectionError("Connection closed before the reply payload.")
+    return payload.decode("utf-8", "replace")
+
+  def _check_replies(self, payload: str, replies: list[i3ipc.CommandReply]) -> None:
+    # Buffered commands are sent joined with ';', and sway replies to each of
+    # them in turn.
+    commands = payload.split(";")
+    if len(commands) != len(replies):
+      commands = [payload] * len(replies)
+
+    for command, reply in zip(commands, replies):
+      if not reply.success:
+        self.failed += 1
+        logging.error(f"Command {command.strip()!r} failed: {reply.error}")
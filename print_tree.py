@@ -5,4 +5,6 @@ import common
 
 
 i3 = i3ipc.Connection()
-print(common.tree_str(common.get_focused_workspace(i3)))
+workspace_id = common.get_focused_workspace_id(i3)
+tree = common.parse_tree(i3.get_tree().ipc_data, i3, {workspace_id})
+print(common.tree_str(tree.find_by_id(workspace_id)))
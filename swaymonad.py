@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 import argparse
-from collections.abc import Callable, Iterator
+import contextlib
+from collections.abc import Callable, Iterator, Set
 import functools
+import glob
 import itertools
+import json
 import logging
+import os
 import shlex
+import signal
+import socket
 import sys
+import threading
 import traceback
 import time
+from typing import Any, Optional
 try:
   from typing import Concatenate, ParamSpec
 except ImportError:
@@ -15,20 +23,48 @@ except ImportError:
 
 import i3ipc
 
+import command_optimizer
 import common
+import config
+import control_socket
 import cycle_windows
 import layout
+import logging_setup
 import master_operations
+import move_counter
 import n_col
 import nop_layout
+import pipeline
 import transformations
+import window_rules
+import window_tracker
+import work_queue
 
 argparser = argparse.ArgumentParser(description='An xmonad-like auto-tiler for sway.')
-argparser.add_argument('--default-layout', default="tall",
-                       help="Layout to use for workspaces where the layout has not been manually set."
-                       "Valid options are 'tall', '3_col', and 'nop'.")
+argparser.add_argument('--default-layout',
+                       help="Layout to use for workspaces where the layout has not been manually set. "
+                       "Valid options are 'tall', '3_col', and 'nop'. "
+                       "Overrides the default layout set in the config file.")
+argparser.add_argument('--config', default=config.default_path(),
+                       help=("Config file path, defaults to $XDG_CONFIG_HOME/swaymonad/config.ini. "
+                             "Reloaded on SIGHUP."))
 argparser.add_argument('--verbose', "-v", action="count", help="Enable debug logging.")
 argparser.add_argument('--log-file', help="Log file path, defaults to stderr.")
+argparser.add_argument('--log-max-bytes', default=10 * 1024 * 1024, type=int,
+                       help="Rotate the log file once it reaches this size, or never if 0.")
+argparser.add_argument('--log-backup-count', default=3, type=int,
+                       help="Number of rotated log files to keep.")
+argparser.add_argument('--log-rate-limit', default=0, type=int,
+                       help=("Log at most n debug messages per second from each place in the code, "
+                             "or all of them if 0."))
+argparser.add_argument('--control-socket', default=control_socket.default_path(),
+                       help=("Path of the unix socket to accept commands on, "
+                             "or an empty string to disable it."))
+argparser.add_argument('--ipc-timeout', default=2.0, type=float,
+                       help=("Seconds to wait for sway to answer a request before treating "
+                             "the connection as stalled and reconnecting."))
+argparser.add_argument('--ipc-reconnect-timeout', default=60.0, type=float,
+                       help="Seconds to keep trying to reconnect to sway before exiting.")
 argparser.add_argument('--delay', default=0.0, type=float,
                        help=("Sleep for n seconds before sending every command to sway, "
                              "allowing a human to observe intermediate state,"))
@@ -55,36 +91,205 @@ COMMANDS: dict[str, Command] = {
   "decrement_masters": layout.decrement_masters_dispatcher,
   "move": layout.move_dispatcher,
   "fullscreen": layout.fullscreen_dispatcher,
+  "send_to_workspace": layout.send_to_workspace,
 }
 
 
-def parse_binding(event: i3ipc.Event) -> Iterator[list[str]]:
-  logging.debug(f"Parsing command: {event.binding.command}")
-  split_commands = shlex.split(event.binding.command)
+# Commands that are cheap and directly awaited by the user, which are run ahead of
+# any queued relayouts.
+INTERACTIVE_COMMANDS = frozenset({
+  "focus_master",
+  "focus_next_window",
+  "focus_prev_window",
+  "swap_with_next_window",
+  "swap_with_prev_window",
+})
+
+
+def parse_commands(command: str, require_nop: bool = True) -> Iterator[list[str]]:
+  logging.debug(f"Parsing command: {command}")
   delims = ';,'
-  for _, group in itertools.groupby(split_commands, key=lambda s: s in delims):
+  lexer = shlex.shlex(command, posix=True, punctuation_chars=delims)
+  lexer.whitespace_split = True
+  split_commands = list(lexer)
+  for is_delim, group in itertools.groupby(split_commands, key=lambda s: s in delims):
     group = list(group)
+    if is_delim:
+      continue
     if group[0] == 'nop':
-      yield group[1:]
+      group = group[1:]
+    elif require_nop:
+      continue
+    if group:
+      yield group
+
+
+def command_priority(commands: list[list[str]]) -> work_queue.Priority:
+  if all(command[0] in INTERACTIVE_COMMANDS for command in commands):
+    return work_queue.Priority.INTERACTIVE
+  return work_queue.Priority.COMMAND
 
 
 def command_dispatcher(i3: i3ipc.Connection, event: i3ipc.Event):
+  # Every binding in sway is sent to us, so cheaply skip the ones that can't
+  # possibly contain any of our commands.
+  if "nop" not in event.binding.command:
+    return
+
   logging.debug(f"Receved command event: {event.ipc_data}")
 
-  commands = list(parse_binding(event))
+  commands = list(parse_commands(event.binding.command))
   logging.debug(f"Parsed commands: {commands}")
   if not commands:
     return
 
-  try:
-    i3.enable_command_buffering()
+  work_queue.QUEUE.put(command_priority(commands), f"commands {commands}",
+                       lambda: run_commands(i3, event, commands))
+
+
+def execute_commands(i3: i3ipc.Connection,
+                     event: Optional[i3ipc.Event],
+                     commands: list[list[str]]) -> None:
+  with i3.buffered_commands():
     for command in commands:
       COMMANDS.get(command[0], lambda i3, event, *args: None)(i3, event, *command[1:])
-    i3.disable_command_buffering()
+
+
+def run_commands(i3: i3ipc.Connection, event: i3ipc.Event, commands: list[list[str]]):
+  try:
+    execute_commands(i3, event, commands)
   except Exception as ex:
     traceback.print_exc()
 
 
+def control_dispatcher(i3: i3ipc.Connection, commands: list[list[str]]) -> None:
+  if not commands:
+    raise ValueError("No commands given.")
+  if unknown := [command[0] for command in commands if command[0] not in COMMANDS]:
+    raise ValueError(f"Unknown commands: {unknown}")
+
+  done = threading.Event()
+  errors: list[Exception] = []
+
+  def run() -> None:
+    try:
+      execute_commands(i3, None, commands)
+    except Exception as ex:
+      traceback.print_exc()
+      errors.append(ex)
+      done.set()
+      return
+    # Any relayout the commands scheduled is queued ahead of this at the same
+    # priority, so the reply also waits for those to have run.
+    work_queue.QUEUE.put(work_queue.Priority.RELAYOUT,
+                         f"reply to control socket commands {commands}", finish)
+
+  def finish() -> None:
+    try:
+      # Only reply once sway has actually run the commands.
+      i3.wait_for_commands()
+    except Exception as ex:
+      traceback.print_exc()
+      errors.append(ex)
+    finally:
+      done.set()
+
+  work_queue.QUEUE.put(command_priority(commands), f"control socket commands {commands}", run)
+  done.wait()
+  if errors:
+    raise errors[0]
+
+
+def discount_move() -> None:
+  if move_counter.value:
+    logging.debug(f"Move counter was non-zero ({move_counter.value}), discounting move event.")
+    move_counter.decrement()
+
+
+def window_event_dispatcher(i3: i3ipc.Connection, event: i3ipc.Event):
+  # Windows matching a rule are dealt with here, before a layout pass is ever
+  # queued for them.
+  if (rule := window_rules.match_event(config.CONFIG.rules, event)) is not None:
+    logging.debug(f"Container {event.container.id} matches {rule}, not queueing a layout pass.")
+    if event.change == "move":
+      # Moves we make ourselves are counted whatever the window, so the count
+      # has to be settled in order with the other move events.
+      work_queue.QUEUE.put(work_queue.Priority.RELAYOUT,
+                           f"move event for ruled container {event.container.id}",
+                           discount_move)
+    elif event.change == "new":
+      work_queue.QUEUE.put(work_queue.Priority.COMMAND,
+                           f"{rule} for container {event.container.id}",
+                           lambda: rule.apply(i3, event.container.id))
+    return
+
+  work_queue.QUEUE.put(work_queue.Priority.RELAYOUT,
+                       f"window {event.change} event for container {event.container.id}",
+                       lambda: layout.layout_dispatcher(i3, event))
+
+
+def reload_config(i3: i3ipc.Connection) -> None:
+  try:
+    new_config = config.load(args.config, layout.LAYOUTS, args.default_layout)
+  except Exception as ex:
+    logging.error(f"Failed to reload config from {args.config}, keeping the current config: {ex}")
+    return
+  logging.debug(f"Reloaded config from {args.config}.")
+  layout.apply_config(i3, new_config)
+
+
+def schedule_config_reload(i3: i3ipc.Connection) -> None:
+  work_queue.QUEUE.put(work_queue.Priority.COMMAND, "config reload",
+                       lambda: reload_config(i3), key=("reload_config",))
+
+
+def resync(i3: i3ipc.Connection) -> None:
+  # sway may have restarted, in which case every container id we know of is
+  # stale, so rebuild all state keyed by ids from scratch, carrying layouts
+  # over by workspace name.
+  i3.reconnect()
+  move_counter.value = 0
+  window_rules.RULED_CONTAINERS.clear()
+  window_tracker.reset(i3)
+  layout.resync_layouts(i3)
+
+
+def read_events(i3: i3ipc.Connection) -> None:
+  try:
+    while True:
+      try:
+        i3.main()
+        logging.warning("Lost the event connection to sway, reconnecting.")
+      except Exception as ex:
+        logging.warning(f"Event connection to sway failed ({ex!r}), reconnecting.")
+
+      try:
+        sock, i3._socket_path = connect_with_backoff(i3.socket_path)
+        sock.close()
+      except OSError as ex:
+        logging.error(f"Could not reconnect to sway, exiting: {ex!r}")
+        return
+      work_queue.QUEUE.put(work_queue.Priority.INTERACTIVE, "resync", lambda: resync(i3),
+                           key=("resync",))
+  finally:
+    work_queue.QUEUE.close()
+
+
+def stats(i3: i3ipc.Connection) -> dict[str, object]:
+  return {
+    "queue": work_queue.QUEUE.stats_str(),
+    "ipc_stalls": i3.stalls,
+    "ipc_stall_time": round(i3.stall_time, 3),
+    "ipc_max_stall": round(i3.max_stall, 3),
+    "ipc_reconnects": i3.reconnects,
+    "read_cache_hits": i3.read_hits,
+    "read_cache_misses": i3.read_misses,
+    "commands_sent": i3.pipeline.sent,
+    "commands_failed": i3.pipeline.failed,
+    "commands_optimized_away": command_optimizer.removed_total,
+  }
+
+
 layout.LAYOUTS.update({
   "tall": functools.partial(n_col.NCol, n_columns=2),
   "3_col": functools.partial(n_col.NCol, n_columns=3),
@@ -92,12 +297,145 @@ layout.LAYOUTS.update({
 })
 
 
+def mtime(path: str) -> float:
+  try:
+    return os.path.getmtime(path)
+  except OSError:
+    return 0.0
+
+
+def socket_paths(path: str) -> list[str]:
+  # sway's socket path includes its pid, so once sway restarts the old path is
+  # gone for good and the new socket has to be found again.
+  runtime_dir = os.environ.get("XDG_RUNTIME_DIR", "/tmp")
+  candidates = glob.glob(os.path.join(runtime_dir, f"sway-ipc.{os.getuid()}.*.sock"))
+  candidates.sort(key=mtime, reverse=True)
+  return [path] + [candidate for candidate in candidates if candidate != path]
+
+
+def connect_with_backoff(path: str) -> tuple[socket.socket, str]:
+  # Returns the connected socket along with the path it was connected on.
+  delay = 0.05
+  deadline = time.monotonic() + args.ipc_reconnect_timeout
+  while True:
+    for candidate in socket_paths(path):
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+        sock.connect(candidate)
+      except OSError as ex:
+        sock.close()
+        error = ex
+        continue
+      if candidate != path:
+        logging.warning(f"sway's socket moved from {path} to {candidate}.")
+      return sock, candidate
+
+    if time.monotonic() + delay > deadline:
+      raise error
+    logging.warning(f"Connecting to sway failed ({error!r}), retrying in {delay:.2f}s.")
+    time.sleep(delay)
+    delay = min(delay * 2, 5.0)
+
+
 class Connection(i3ipc.Connection):
 
-  def __init__(self, *args, **kwargs) -> None:
-    super().__init__(*args, **kwargs)
+  def __init__(self, *conn_args, **kwargs) -> None:
+    super().__init__(*conn_args, **kwargs)
+    self._cmd_socket.settimeout(args.ipc_timeout)
     self.buffering_commands = False
     self.command_buffer: list[str] = []
+    self.pipeline = pipeline.CommandPipeline(self, args.ipc_timeout)
+
+    self.stalls = 0
+    self.stall_time = 0.0
+    self.max_stall = 0.0
+    self.reconnects = 0
+
+    # Replies to reads, as key -> (read generation, reply). A reply is reused
+    # until the generation moves on, which happens whenever sway's state may
+    # have changed: a command is sent, an event arrives, or a new unit of work
+    # starts (not every state change, e.g. mouse focus, produces an event).
+    self._generations = itertools.count()
+    self.read_generation = next(self._generations)
+    self._reads: dict[str, tuple[int, Any]] = {}
+    self.read_hits = 0
+    self.read_misses = 0
+
+  def invalidate_reads(self) -> None:
+    # Called from both the main and the event thread; next() on a count is
+    # atomic.
+    self.read_generation = next(self._generations)
+
+  def cached_read(self, key: str, fetch: Callable[[], Any]) -> Any:
+    # Buffered commands haven't been sent yet, so they don't move the
+    # generation on, but a read must still see their effects.
+    if (not self.command_buffer and
+        (cached := self._reads.get(key)) is not None and cached[0] == self.read_generation):
+      self.read_hits += 1
+      logging.debug(f"Reusing {key} reply from read generation {cached[0]}.", stacklevel=3)
+      return cached[1]
+
+    was_buffering = self.disable_command_buffering_for_read()
+    # Flushing buffered commands moves the generation on, and the reply must be
+    # stored under the generation from before the request was sent, so that
+    # an event arriving while it is in flight still invalidates it.
+    generation = self.read_generation
+    try:
+      reply = fetch()
+    finally:
+      self.buffering_commands = was_buffering
+    self.read_misses += 1
+    self._reads[key] = (generation, reply)
+    return reply
+
+  def _ipc_recv(self, sock: socket.socket) -> tuple[str, int]:
+    data = super()._ipc_recv(sock)
+    # Events are only sent after sway's state changed. This runs before the
+    # event is handed to any handler.
+    if sock is self._sub_socket:
+      self.invalidate_reads()
+    return data
+
+  def record_stall(self, duration: float, what: str, ex: Optional[Exception]) -> None:
+    self.stalls += 1
+    self.stall_time += duration
+    self.max_stall = max(self.max_stall, duration)
+    logging.warning(f"IPC stalled for {duration:.3f}s waiting for {what} ({ex!r}); "
+                    f"{self.stalls} stalls totalling {self.stall_time:.3f}s so far.")
+
+  def reconnect(self) -> None:
+    # Both sockets are replaced, as after a timeout a late reply could still
+    # arrive on them and be mistaken for the reply to a later request.
+    cmd_socket, self._socket_path = connect_with_backoff(self.socket_path)
+    cmd_socket.settimeout(args.ipc_timeout)
+    with self._cmd_lock:
+      old_cmd_socket, self._cmd_socket = self._cmd_socket, cmd_socket
+    old_cmd_socket.close()
+    self.pipeline.close()
+    self.pipeline = pipeline.CommandPipeline(self, args.ipc_timeout)
+    self.reconnects += 1
+    self.invalidate_reads()
+    logging.warning(f"Reconnected to {self.socket_path} ({self.reconnects} reconnects so far).")
+
+  def _message(self, message_type: i3ipc.connection.MessageType, payload: str) -> str:
+    # Only used for reads (commands go through the pipeline), so they are safe
+    # to retry once after reconnecting.
+    for attempt in range(2):
+      start = time.monotonic()
+      try:
+        return super()._message(message_type, payload)
+      except OSError as ex:
+        self.record_stall(time.monotonic() - start, f"{message_type.name} reply", ex)
+        if attempt:
+          raise
+        self.reconnect()
+    raise AssertionError("unreachable")
+
+  def wait_for_commands(self) -> None:
+    start = time.monotonic()
+    if not self.pipeline.wait(args.ipc_timeout):
+      self.record_stall(time.monotonic() - start, "command replies", None)
+      self.reconnect()
 
   def command(self, payload: str) -> list[i3ipc.CommandReply]:
     if self.buffering_commands:
@@ -105,9 +443,34 @@ class Connection(i3ipc.Connection):
       self.command_buffer.append(payload)
       return []
 
+    # Replies are checked asynchronously by the pipeline, which logs any
+    # failures, so like buffered commands there are no replies to return.
     logging.debug(f"Executing command: {payload}", stacklevel=2)
     time.sleep(args.delay)
-    return super().command(payload)
+    self.invalidate_reads()
+    try:
+      self.pipeline.submit(payload)
+    except OSError as ex:
+      logging.warning(f"Sending command failed ({ex!r}), reconnecting and retrying.")
+      self.reconnect()
+      self.pipeline.submit(payload)
+    return []
+
+  @contextlib.contextmanager
+  def buffered_commands(self) -> Iterator[None]:
+    # Commands buffered by a handler that fails part way through would
+    # otherwise go out with whatever flushes the buffer next, so they are
+    # dropped instead.
+    self.enable_command_buffering()
+    try:
+      yield
+    except BaseException:
+      if self.command_buffer:
+        logging.debug(f"Discarding {len(self.command_buffer)} buffered commands after an error.")
+      self.command_buffer = []
+      raise
+    finally:
+      self.disable_command_buffering()
 
   def enable_command_buffering(self) -> None:
     self.buffering_commands = True
@@ -118,39 +481,88 @@ class Connection(i3ipc.Connection):
     if not self.command_buffer:
       return []
 
-    command = ";".join(self.command_buffer)
+    command = ";".join(command_optimizer.optimize(self.command_buffer))
     self.command_buffer = []
     return self.command(command)
 
-  def get_tree(self) -> i3ipc.Con:
-    # TODO: handle returned errors
+  def disable_command_buffering_for_read(self) -> bool:
+    # Reads must see the effects of any buffered commands, so flush them first
+    # and wait for sway to have run everything sent so far.
+    # Returns whether buffering should be resumed after the read.
+    was_buffering = self.buffering_commands
     self.disable_command_buffering()
-    tree = super().get_tree()
-    self.enable_command_buffering()
-    return tree
+    self.wait_for_commands()
+    return was_buffering
+
+  def get_tree(self, workspace_ids: Optional[Set[int]] = None) -> common.Node:
+    # TODO: handle returned errors
+    # Bypass i3ipc.Con, which keeps every field of every node, in favor of the
+    # much lighter common.Node. The decoded reply is what's cached, so every
+    # caller gets its own tree to mutate.
+    data = self.cached_read(
+      "tree", lambda: json.loads(self._message(i3ipc.connection.MessageType.GET_TREE, "")))
+    return common.parse_tree(data, self, workspace_ids)
 
   def get_workspaces(self) -> list[i3ipc.replies.WorkspaceReply]:
     # TODO: handle returned errors
-    self.disable_command_buffering()
-    workspaces = super().get_workspaces()
-    self.enable_command_buffering()
-    return workspaces
+    return self.cached_read("workspaces", super().get_workspaces)
+
+  def get_seats(self) -> list[i3ipc.replies.SeatReply]:
+    return self.cached_read("seats", super().get_seats)
 
 
 if __name__ == "__main__":
-  logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+  logging_setup.setup(level=logging.DEBUG if args.verbose else logging.WARNING,
                       filename=args.log_file,
-                      format='%(asctime)s, %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s')
+                      max_bytes=args.log_max_bytes,
+                      backup_count=args.log_backup_count,
+                      rate_limit=args.log_rate_limit)
 
-  layout.DEFAULT_LAYOUT = args.default_layout
+  config.CONFIG = config.load(args.config, layout.LAYOUTS, args.default_layout)
 
   i3 = Connection()
 
-  i3.on(i3ipc.Event.BINDING, command_dispatcher)
+  # Signal handlers run on the main thread, which may be in the middle of
+  # taking work off the queue, so hand the reload off to another thread
+  # instead of queueing it from the handler itself.
+  signal.signal(signal.SIGHUP,
+                lambda signum, frame: threading.Thread(
+                  target=schedule_config_reload, args=(i3,), daemon=True).start())
 
-  i3.on(i3ipc.Event.WINDOW_NEW, layout.layout_dispatcher)
-  i3.on(i3ipc.Event.WINDOW_CLOSE, layout.layout_dispatcher)
-  i3.on(i3ipc.Event.WINDOW_MOVE, layout.layout_dispatcher)
+  window_tracker.initialize(i3)
 
-  i3.main()
+  i3.on(i3ipc.Event.BINDING, command_dispatcher)
+  i3.on(i3ipc.Event.WORKSPACE, window_tracker.on_workspace_event)
+
+  # The tracker has to see structural changes before any layout pass is queued
+  # for them.
+  for event_type in (i3ipc.Event.WINDOW_NEW, i3ipc.Event.WINDOW_CLOSE, i3ipc.Event.WINDOW_MOVE,
+                     i3ipc.Event.WINDOW_FLOATING, i3ipc.Event.WINDOW_FOCUS,
+                     i3ipc.Event.WINDOW_FULLSCREEN_MODE):
+    i3.on(event_type, window_tracker.on_window_event)
+  i3.on(i3ipc.Event.WINDOW_NEW, window_event_dispatcher)
+  i3.on(i3ipc.Event.WINDOW_CLOSE, window_event_dispatcher)
+  i3.on(i3ipc.Event.WINDOW_MOVE, window_event_dispatcher)
+
+  if args.control_socket:
+    try:
+      server = control_socket.ControlServer(
+        args.control_socket,
+        parse=lambda request: list(parse_commands(request, require_nop=False)),
+        dispatch=lambda commands: control_dispatcher(i3, commands),
+        stats=lambda: stats(i3))
+    except RuntimeError as ex:
+      logging.error(f"Not starting: {ex}")
+      sys.exit(1)
+    server.start()
+
+  # Events are read on their own thread and only queued there, so that bindings
+  # can be picked up (and prioritized) while a layout pass is still running.
+  threading.Thread(target=read_events, args=(i3,), name="event-reader", daemon=True).start()
+  try:
+    work_queue.QUEUE.run(before_item=i3.invalidate_reads)
+  finally:
+    if args.control_socket:
+      server.server_close()
+  logging.debug(f"Work queue stats: {work_queue.QUEUE.stats_str()}")
 
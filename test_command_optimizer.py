@@ -0,0 +1,57 @@
+import command_optimizer
+
+
+def optimize(*commands: str) -> list[str]:
+  return command_optimizer.optimize(commands)
+
+
+def test_repeated_focus_is_dropped() -> None:
+  assert optimize('[con_id="1"] focus',
+                  '[con_id="2"] mark m',
+                  '[con_id="1"] focus') == ['[con_id="1"] focus', '[con_id="2"] mark m']
+
+
+def test_focus_after_other_command_is_kept() -> None:
+  commands = ['[con_id="1"] focus', '[con_id="2"] focus', '[con_id="1"] focus']
+  assert optimize(*commands) == commands
+
+
+def test_repeated_absolute_split_is_dropped() -> None:
+  assert optimize('[con_id="1"] splitv', '[con_id="1"] splitv') == ['[con_id="1"] splitv']
+
+
+def test_toggles_and_layout_commands_are_kept() -> None:
+  for command in ('[con_id="1"] layout toggle split', '[con_id="1"] split toggle',
+                  '[con_id="1"] splitt', '[con_id="1"] layout splitv'):
+    assert optimize(command, command) == [command, command]
+
+
+def test_split_after_split_of_other_container_is_kept() -> None:
+  commands = ['[con_id="1"] splitv', '[con_id="2"] splith', '[con_id="1"] splitv']
+  assert optimize(*commands) == commands
+
+
+def test_unmark_then_mark_on_same_container_cancels() -> None:
+  assert optimize('[con_id="1"] mark m',
+                  '[con_id="2"] move window to mark m',
+                  '[con_id="1"] unmark m',
+                  '[con_id="1"] mark m') == ['[con_id="1"] mark m',
+                                             '[con_id="2"] move window to mark m']
+
+
+def test_unmark_then_mark_on_other_container_drops_unmark() -> None:
+  assert optimize('[con_id="1"] unmark m', '[con_id="3"] mark m') == ['[con_id="3"] mark m']
+
+
+def test_swap_pair_cancels() -> None:
+  assert optimize('[con_id="1"] swap container with con_id 2',
+                  '[con_id="2"] swap container with con_id 1') == []
+
+
+def test_commands_without_criteria_are_barriers() -> None:
+  commands = ['[con_id="1"] focus', 'workspace 2', '[con_id="1"] focus']
+  assert optimize(*commands) == commands
+
+
+def test_joined_payloads_are_split_outside_quotes() -> None:
+  assert optimize('[con_id="1"] focus; workspace "a;b"') == ['[con_id="1"] focus', 'workspace "a;b"']
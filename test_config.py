@@ -0,0 +1,12 @@
+import config
+
+
+def test_lookup_precedence() -> None:
+  cfg = config.Config(config.LayoutSettings(n_columns=3),
+                      workspaces={"9": {"layout": "nop"}},
+                      outputs={"DP-1": {"layout": "tall", "n_masters": 2}})
+
+  assert cfg.lookup("9", "DP-1") == config.LayoutSettings("nop", 2, 3)
+  assert cfg.lookup("1", "DP-1") == config.LayoutSettings("tall", 2, 3)
+  assert cfg.lookup("9", "HDMI-1") == config.LayoutSettings("nop", 1, 3)
+  assert cfg.lookup("1", None) == config.LayoutSettings("tall", 1, 3)
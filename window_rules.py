@@ -0,0 +1,100 @@
+import enum
+import logging
+import re
+from collections.abc import Iterable
+from typing import Optional
+
+import i3ipc
+
+import common
+
+
+class Action(common.AutoName):
+  # Make the window floating as soon as it appears.
+  FLOATING = enum.auto()
+
+
+class Rule:
+
+  def __init__(self,
+               name: str,
+               action: Action,
+               app_id: Optional[str] = None,
+               window_class: Optional[str] = None,
+               title: Optional[str] = None,
+               window_type: Optional[str] = None) -> None:
+    self.name = name
+    self.action = action
+    self.app_id = app_id
+    self.window_class = window_class
+    self.title = re.compile(title) if title is not None else None
+    self.window_type = window_type
+
+  def __repr__(self) -> str:
+    return f"{type(self).__name__}({self.name}, {self.action.value})"
+
+  def matches(self, container: i3ipc.Con) -> bool:
+    return ((self.app_id is None or container.app_id == self.app_id) and
+            (self.window_class is None or container.window_class == self.window_class) and
+            (self.title is None or
+             (container.name is not None and self.title.search(container.name) is not None)) and
+            (self.window_type is None or window_type(container) == self.window_type))
+
+  def apply(self, i3: i3ipc.Connection, container_id: int) -> None:
+    logging.debug(f"Applying {self} to container {container_id}.")
+    if self.action == Action.FLOATING:
+      i3.command(f'[con_id="{container_id}"] floating enable')
+
+
+def window_type(container: i3ipc.Con) -> Optional[str]:
+  return container.ipc_data.get("window_properties", {}).get("window_type")
+
+
+class RuleIndex:
+  """Rules indexed by the app_id or class they require.
+
+  Rules that require neither are checked for every window, so rules should
+  name the app_id or class of the windows they apply to wherever possible.
+  """
+
+  def __init__(self, rules: Iterable[Rule] = ()) -> None:
+    self.rules = list(rules)
+    self.by_app_id: dict[str, list[tuple[int, Rule]]] = {}
+    self.by_class: dict[str, list[tuple[int, Rule]]] = {}
+    self.generic: list[tuple[int, Rule]] = []
+    for i, rule in enumerate(self.rules):
+      if rule.app_id is not None:
+        self.by_app_id.setdefault(rule.app_id, []).append((i, rule))
+      elif rule.window_class is not None:
+        self.by_class.setdefault(rule.window_class, []).append((i, rule))
+      else:
+        self.generic.append((i, rule))
+
+  def match(self, container: i3ipc.Con) -> Optional[Rule]:
+    # Rules are tried in the order they were defined in.
+    candidates = sorted(self.by_app_id.get(container.app_id, []) +
+                        self.by_class.get(container.window_class, []) +
+                        self.generic,
+                        key=lambda candidate: candidate[0])
+    return next((rule for _, rule in candidates if rule.matches(container)), None)
+
+
+# Containers that matched a rule when they were created, by id.
+RULED_CONTAINERS: dict[int, Rule] = {}
+
+
+def match_event(rules: RuleIndex, event: i3ipc.Event) -> Optional[Rule]:
+  """Returns the rule governing the window of the event, if any.
+
+  Windows are only matched against the rules when they are created, so later
+  changes to e.g. their title don't change whether swaymonad manages them.
+  """
+  container_id = event.container.id
+  if event.change == "new":
+    if (rule := rules.match(event.container)) is not None:
+      RULED_CONTAINERS[container_id] = rule
+    return rule
+  elif event.change == "close":
+    return RULED_CONTAINERS.pop(container_id, None)
+  else:
+    return RULED_CONTAINERS.get(container_id)
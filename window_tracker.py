@@ -0,0 +1,160 @@
+import collections
+import logging
+from typing import Optional
+
+import i3ipc
+
+# Most recently focused workspaces as (id, name), most recent last. Updated from
+# workspace events on the event thread.
+workspace_history: collections.deque[tuple[int, str]] = collections.deque(maxlen=16)
+
+# The workspace each container was on as of the last layout pass of that
+# workspace.
+container_workspaces: dict[int, int] = {}
+
+# The focused window and whether it is fullscreen, updated from window events on
+# the event thread and from focus commands we send ourselves.
+focused_id: Optional[int] = None
+focused_fullscreen = False
+# Ids of windows we focused ourselves whose focus events haven't arrived yet,
+# oldest first. Until they have, the focused window we recorded is more recent
+# than what the events say.
+pending_focus: collections.deque[int] = collections.deque()
+
+# Bumped on the event thread whenever windows are added to, removed from or
+# moved between tiling layouts.
+structure_generation = 0
+# The tiled leaves of each workspace, in the order cycle_windows walks them, as
+# of the last layout pass of that workspace, along with the structure
+# generation the pass saw. Only valid while that is still the current
+# generation.
+workspace_leaves: dict[int, tuple[int, list[int]]] = {}
+
+
+def initialize(i3: i3ipc.Connection) -> None:
+  global focused_id, focused_fullscreen
+  for reply in i3.get_workspaces():
+    if reply.focused:
+      workspace_history.append((reply.ipc_data["id"], reply.name))
+  tree = i3.get_tree()
+  for workspace in tree:
+    if workspace.type == "workspace":
+      record_workspace(workspace)
+  if (focused := tree.find_focused()) is not None and focused.type in ("con", "floating_con"):
+    focused_id = focused.id
+    focused_fullscreen = focused.fullscreen_mode == 1
+
+
+def reset(i3: i3ipc.Connection) -> None:
+  global focused_id, structure_generation
+  workspace_history.clear()
+  container_workspaces.clear()
+  workspace_leaves.clear()
+  pending_focus.clear()
+  focused_id = None
+  structure_generation += 1
+  initialize(i3)
+
+
+def on_window_event(i3: i3ipc.Connection, event: i3ipc.Event) -> None:
+  global focused_id, focused_fullscreen, structure_generation
+  del i3
+  if event.change in ("new", "close", "move", "floating"):
+    structure_generation += 1
+  elif event.change == "focus":
+    if pending_focus and pending_focus[0] == event.container.id:
+      pending_focus.popleft()
+      if pending_focus:
+        return
+    else:
+      # Focus changed by other means than us, so whatever else we expected is
+      # moot.
+      pending_focus.clear()
+    focused_id = event.container.id
+    focused_fullscreen = event.container.fullscreen_mode == 1
+  elif event.change == "fullscreen_mode" and event.container.id == focused_id:
+    focused_fullscreen = event.container.fullscreen_mode == 1
+
+
+def on_workspace_event(i3: i3ipc.Connection, event: i3ipc.Event) -> None:
+  del i3
+  if event.current is None:
+    return
+
+  current = (event.current.id, event.current.name)
+  if event.change == "focus":
+    workspace_history.append(current)
+  elif event.change == "rename":
+    for i, (workspace_id, _) in enumerate(workspace_history):
+      if workspace_id == current[0]:
+        workspace_history[i] = current
+  elif event.change == "empty":
+    for entry in [entry for entry in workspace_history if entry[0] == current[0]]:
+      workspace_history.remove(entry)
+  logging.debug(f"Workspace {event.change} event for {current}, "
+                f"focus history is now {list(workspace_history)}.")
+
+
+def focused_workspace() -> Optional[tuple[int, str]]:
+  return workspace_history[-1] if workspace_history else None
+
+
+def previous_workspace(exclude: int) -> Optional[int]:
+  # The most recently focused workspace other than exclude, i.e. where
+  # "workspace back_and_forth" would go from exclude. The history is copied
+  # first as the event thread may be appending to it.
+  return next((workspace_id for workspace_id, _ in reversed(list(workspace_history))
+               if workspace_id != exclude), None)
+
+
+def record_workspace(workspace: i3ipc.Con, generation: Optional[int] = None) -> None:
+  # generation should be read before the workspace was fetched, so that any
+  # event arriving in between invalidates what's recorded here.
+  for con in workspace:
+    container_workspaces[con.id] = workspace.id
+  workspace_leaves[workspace.id] = (
+    structure_generation if generation is None else generation,
+    [leaf.id for leaf in workspace.leaves()])
+
+
+def forget_workspace(workspace_id: int) -> None:
+  workspace_leaves.pop(workspace_id, None)
+
+
+def record_focus(container_id: int, fullscreen: bool) -> None:
+  global focused_id, focused_fullscreen
+  pending_focus.append(container_id)
+  focused_id = container_id
+  focused_fullscreen = fullscreen
+
+
+def record_swap(con1_id: int, con2_id: int) -> None:
+  for _, leaves in workspace_leaves.values():
+    for i, leaf_id in enumerate(leaves):
+      if leaf_id == con1_id:
+        leaves[i] = con2_id
+      elif leaf_id == con2_id:
+        leaves[i] = con1_id
+
+
+def focused_leaves() -> Optional[tuple[int, bool, list[int]]]:
+  """Returns the focused window, whether it's fullscreen, and the leaves of its workspace.
+
+  Returns None if any of these aren't known for certain, in which case they
+  have to be read from the tree.
+  """
+  container_id, fullscreen = focused_id, focused_fullscreen
+  if container_id is None or (workspace_id := container_workspaces.get(container_id)) is None:
+    return None
+  generation, leaves = workspace_leaves.get(workspace_id, (None, []))
+  if generation != structure_generation or container_id not in leaves:
+    return None
+  return container_id, fullscreen, leaves
+
+
+def forget_container(container_id: int) -> None:
+  container_workspaces.pop(container_id, None)
+
+
+def container_workspace(container_id: int) -> Optional[int]:
+  return container_workspaces.get(container_id)
@@ -0,0 +1,122 @@
+import enum
+import heapq
+import itertools
+import logging
+import threading
+import time
+import traceback
+from collections.abc import Callable, Hashable
+from typing import Optional
+
+
+class Priority(enum.IntEnum):
+  # Cheap commands the user is waiting on, e.g. focus and swap bindings.
+  INTERACTIVE = 0
+  # Other commands, which may themselves schedule relayouts.
+  COMMAND = 1
+  # Layout passes triggered by window events or commands.
+  RELAYOUT = 2
+
+
+class WorkItem:
+
+  def __init__(self,
+               priority: Priority,
+               sequence: int,
+               name: str,
+               func: Callable[[], None],
+               key: Optional[Hashable]) -> None:
+    self.priority = priority
+    self.sequence = sequence
+    self.name = name
+    self.func = func
+    self.key = key
+    self.enqueued_at = time.monotonic()
+
+  def __lt__(self, other: "WorkItem") -> bool:
+    return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+  def __repr__(self) -> str:
+    return f"{type(self).__name__}({self.name}, {self.priority.name})"
+
+
+class WorkQueue:
+  """A priority queue of work fed by the event thread and drained by the main thread.
+
+  Items with the same priority run in the order they were submitted. Items
+  submitted with a key are deduplicated: while an item with that key is still
+  queued, further submissions with the same key are dropped.
+  """
+
+  def __init__(self) -> None:
+    self._cond = threading.Condition()
+    self._heap: list[WorkItem] = []
+    self._pending: dict[Hashable, WorkItem] = {}
+    self._sequence = itertools.count()
+    self._closed = False
+
+    self.processed = 0
+    self.deduplicated = 0
+    self.max_depth = 0
+    self.total_wait = 0.0
+    self.max_wait = 0.0
+
+  def put(self,
+          priority: Priority,
+          name: str,
+          func: Callable[[], None],
+          key: Optional[Hashable] = None) -> None:
+    with self._cond:
+      if key is not None and key in self._pending:
+        self.deduplicated += 1
+        logging.debug(f"Dropping {name}, {self._pending[key]} with key {key} is already queued.")
+        return
+
+      item = WorkItem(priority, next(self._sequence), name, func, key)
+      heapq.heappush(self._heap, item)
+      if key is not None:
+        self._pending[key] = item
+      self.max_depth = max(self.max_depth, len(self._heap))
+      self._cond.notify()
+
+  def get(self) -> Optional[WorkItem]:
+    with self._cond:
+      while not self._heap and not self._closed:
+        self._cond.wait()
+      if not self._heap:
+        return None
+
+      item = heapq.heappop(self._heap)
+      if item.key is not None:
+        del self._pending[item.key]
+
+      wait = time.monotonic() - item.enqueued_at
+      self.processed += 1
+      self.total_wait += wait
+      self.max_wait = max(self.max_wait, wait)
+      logging.debug(f"Running {item} after waiting {wait * 1000:.1f} ms; "
+                    f"{len(self._heap)} items still queued.")
+      return item
+
+  def close(self) -> None:
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+
+  def run(self, before_item: Optional[Callable[[], None]] = None) -> None:
+    while (item := self.get()) is not None:
+      if before_item is not None:
+        before_item()
+      try:
+        item.func()
+      except Exception as ex:
+        traceback.print_exc()
+
+  def stats_str(self) -> str:
+    mean_wait = self.total_wait / self.processed if self.processed else 0.0
+    return (f"processed={self.processed} deduplicated={self.deduplicated} "
+            f"depth={len(self._heap)} max_depth={self.max_depth} "
+            f"mean_wait={mean_wait * 1000:.1f}ms max_wait={self.max_wait * 1000:.1f}ms")
+
+
+QUEUE = WorkQueue()